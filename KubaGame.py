@@ -4,7 +4,256 @@
 #               marbles or by blocking your opponent from any remaining moves. Marbles can only be pushed
 #               if there is no marble directly in front of where it is pushed from.
 
-from copy import deepcopy
+import random
+import sys
+from collections import OrderedDict
+
+
+# Marbles are represented internally by these codes and converted to "X", "W", "B", and "R" only
+# when returned from the public methods.
+EMPTY, WHITE, BLACK, RED = 0, 1, 2, 3
+_CODE_TO_STR = ("X", "W", "B", "R")
+
+# The colors a player can choose, mapped to their marble codes.
+_PLAYER_COLORS = {"W": WHITE, "B": BLACK}
+
+# Directions are passed to the bitboard functions below as an index into "FBLR".
+_DIR_INDEX = {"F": 0, "B": 1, "L": 2, "R": 3}
+
+# Change in square index for one step in each direction.
+_STRIDE = (-7, 7, -1, 1)
+
+# The row or column that marbles fall off when pushed in each direction.
+_COLUMN_0 = sum(1 << (row * 7) for row in range(7))
+_EDGE_BIT = (0x7F, 0x7F << 42, _COLUMN_0, _COLUMN_0 << 6)
+
+
+def _bit(row, column):
+    '''
+    Takes a row and column and returns the bitboard bit for that square. Square (r, c) is stored
+    in bit r*7+c, so (0, 0) is the lowest bit and (6, 6) is bit 48.
+    '''
+
+    return 1 << (row * 7 + column)
+
+
+def _square_index(coordinates):
+    '''
+    Takes coordinates as a (row, column) tuple and returns the square index r*7+c, or None if the
+    coordinates are off the board. The bounds are checked explicitly, since a column of 7 would
+    otherwise wrap onto the next row.
+    '''
+
+    row, column = coordinates
+    if not (0 <= row < 7 and 0 <= column < 7):
+        return None
+    return row * 7 + column
+
+
+def _next_square(square, direction):
+    '''
+    Takes a square index (r*7+c) and a direction index and returns the index of the neighbouring
+    square in that direction, or None if the square is on the edge of the board.
+    '''
+
+    if _EDGE_BIT[direction] & (1 << square):
+        return None
+    return square + _STRIDE[direction]
+
+
+def _build_rays():
+    '''
+    Returns a tuple indexed by direction of tuples of 49 bitboards, one per square, holding every
+    square from (but not including) that square to the edge of the board in that direction.
+    '''
+
+    rays = []
+
+    for direction in range(4):
+        direction_rays = []
+        for square in range(49):
+            ray = 0
+            next_square = _next_square(square, direction)
+            while next_square is not None:
+                ray |= 1 << next_square
+                next_square = _next_square(next_square, direction)
+            direction_rays.append(ray)
+        rays.append(tuple(direction_rays))
+
+    return tuple(rays)
+
+
+_RAY = _build_rays()
+
+
+def _build_behind():
+    '''
+    Returns a tuple indexed by direction of tuples of 49 bitboards, one per square, holding the bit of
+    the square directly behind that square when pushing in that direction, or 0 if the square is on
+    the edge of the board.
+    '''
+
+    behind = []
+
+    for direction in range(4):
+        direction_behind = []
+        for square in range(49):
+            # Opposite directions differ only in the lowest bit of their index.
+            behind_square = _next_square(square, direction ^ 1)
+            direction_behind.append(0 if behind_square is None else 1 << behind_square)
+        behind.append(tuple(direction_behind))
+
+    return tuple(behind)
+
+
+_BEHIND = _build_behind()
+
+# Starting positions of each color as bitboards.
+_W0 = sum(_bit(i, j) | _bit(6-i, 6-j) for i in range(2) for j in range(2))
+_B0 = sum(_bit(i+5, j) | _bit(i, j+5) for i in range(2) for j in range(2))
+_R0 = sum(_bit(row, column) for row, column in ((1, 3), (2, 2), (2, 3), (2, 4), (3, 1), (3, 2), (3, 3),
+                                                (3, 4), (3, 5), (4, 2), (4, 3), (4, 4), (5, 3)))
+
+# Random Zobrist keys indexed by marble code and square. The EMPTY row is never used.
+_zobrist_random = random.Random(7)
+_ZOBRIST = tuple(tuple(_zobrist_random.getrandbits(64) for square in range(49)) for code in range(4))
+
+# Random Zobrist keys for the side to move, indexed by player index.
+_ZOBRIST_TURN = (_zobrist_random.getrandbits(64), _zobrist_random.getrandbits(64))
+
+# Maximum number of entries kept in each of a game's position caches.
+_CACHE_SIZE = 4096
+
+
+def _position_key(white, black, red):
+    '''
+    Takes the white, black, and red bitboards and packs them into a single int that identifies the
+    position exactly, so two positions can be compared with one int comparison.
+    '''
+
+    return white | black << 49 | red << 98
+
+
+def _zobrist_diff(before, after, color):
+    '''
+    Takes two bitboards of the same color and the marble code for that color, and returns the XOR of
+    the Zobrist keys of every square that differs between them. XOR-ing the result into a position
+    hash updates it from the first bitboard to the second, and passing 0 as the first bitboard gives
+    that color's full contribution to the hash.
+    '''
+
+    key = 0
+    changed = before ^ after
+
+    while changed:
+        lowest_bit = changed & -changed
+        changed ^= lowest_bit
+        key ^= _ZOBRIST[color][lowest_bit.bit_length() - 1]
+
+    return key
+
+
+def _cache_store(cache, key, value):
+    '''
+    Takes an OrderedDict cache, a key, and a value, and stores the value, evicting the least recently
+    used entry once the cache holds more than _CACHE_SIZE entries.
+    '''
+
+    cache[key] = value
+    if len(cache) > _CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def _first_bit(mask, direction):
+    '''
+    Takes a bitboard lying on a single row or column and a direction index, and returns the bit of
+    the mask that comes first when travelling in that direction. Returns 0 for an empty mask.
+    '''
+
+    if _STRIDE[direction] > 0:
+        return mask & -mask
+
+    return 1 << (mask.bit_length() - 1) if mask else 0
+
+
+def _shift(mask, direction):
+    '''
+    Takes a bitboard and a direction index and returns the bitboard with every bit moved one square
+    in that direction. Callers must clear bits on the edge first so nothing wraps to another row.
+    '''
+
+    stride = _STRIDE[direction]
+    if stride > 0:
+        return mask << stride
+    return mask >> -stride
+
+
+def _push_run(occupied, square, direction):
+    '''
+    Takes the occupied bitboard, the square index (r*7+c) of the marble that is being pushed, and the
+    direction index, and returns a tuple (run, fell_off). run holds the pushed marble and every
+    marble directly in front of it up to the first empty square. fell_off is the bit of the marble
+    that is pushed over the edge, or 0 if the run does not reach the edge.
+    '''
+
+    bit = 1 << square
+    ray = _RAY[direction][square]
+    line = bit | ray
+    empty = ray & ~occupied
+
+    if not empty:
+        return (line, line & _EDGE_BIT[direction])
+
+    stop = _first_bit(empty, direction)
+    if stop > bit:
+        return (line & (stop - 1) & ~(bit - 1), 0)
+    return (line & ((bit << 1) - 1) & ~((stop << 1) - 1), 0)
+
+
+def _check_open(occupied, square, direction):
+    '''
+    Takes the occupied bitboard, the square index (r*7+c) of the marble that is being pushed, and the
+    direction index, and returns True if the square behind the marble is empty or off the board.
+    '''
+
+    return not occupied & _BEHIND[direction][square]
+
+
+def _analyze_push(occupied, player_marbles, square, direction):
+    '''
+    Takes the occupied bitboard, the bitboard of the pushing player's marbles, the square index
+    (r*7+c) of the marble that is being pushed, and the direction index, and returns a tuple
+    (open_ok, self_ok). open_ok is True if the marble is 'open' to be pushed and self_ok is True if
+    the push does not remove one of the player's own marbles from the board.
+
+    The run in front of the marble is only scanned when the marble is open; otherwise self_ok is
+    returned as True since the move is already invalid.
+    '''
+
+    if not _check_open(occupied, square, direction):
+        return (False, True)
+
+    return (True, not _push_run(occupied, square, direction)[1] & player_marbles)
+
+
+def _simulate_push(white, black, red, square, direction):
+    '''
+    Takes the white, black, and red bitboards, the square index (r*7+c) of the marble that is being
+    pushed, and the direction index, and returns a tuple (white, black, red, fell_off) of the
+    resulting bitboards and the bit of the marble pushed over the edge, or 0 if none was. That
+    marble is removed from the board.
+
+    The bitboards passed in are not modified, so the result can be compared or discarded freely.
+    '''
+
+    run, fell_off = _push_run(white | black | red, square, direction)
+    kept = run & ~fell_off
+
+    white = white & ~run | _shift(white & kept, direction)
+    black = black & ~run | _shift(black & kept, direction)
+    red = red & ~run | _shift(red & kept, direction)
+
+    return (white, black, red, fell_off)
 
 
 class KubaGame:
@@ -18,52 +267,68 @@ class KubaGame:
         dictate.
         - Determing and returning the winner of the game.
         - Returning the number of marbles captured by the specified player.
-        - Returning the color of a marble at specified coordinates.
+        - Returning the color of a marble at specified coordinates, singly or in batches.
         - Returning the total number of all colored marbles on the game board.
         - Displaying the board in the console.
+        - Undoing moves, cloning the game, and providing a hashable key of the current position.
 
     Class Dependencies: 
-        - Player: used to track the number of red marbles per player
+        - Player: used to store the name and marble color of each player, indexed 0 and 1 in
+        the order they were passed in
     '''
 
+    __slots__ = ("_players", "_name_to_idx", "_turn_idx", "_captured", "_game_winner", "_white", "_black",
+                 "_red", "_occupied", "_counts", "_prev_position_key", "_hash", "_prev_hash",
+                 "_blocked_cache", "_legal_move_cache", "_history", "_legal_moves_cache")
+
+    # Starting (white, black, red) bitboards and the values derived from them, computed once.
+    _INITIAL_STATE = (_W0, _B0, _R0)
+    _INITIAL_COUNTS = (_W0.bit_count(), _B0.bit_count(), _R0.bit_count())
+    _INITIAL_KEY = _position_key(_W0, _B0, _R0)
+    _INITIAL_HASH = _zobrist_diff(0, _W0, WHITE) ^ _zobrist_diff(0, _B0, BLACK) ^ _zobrist_diff(0, _R0, RED)
+
     def __init__(self, player1, player2):
         '''
         Initializes the KubaGame with two specified players. Both players are passed as tuples
         of length two with the first value the player name and the second the color
         represented as either "W" or "B".
 
-        The board is initialized per the game rules with R (red), B (black), and W (white) representing
-        the different colored marbles and X for empty spots on the board.
+        The board is initialized per the game rules and stored as one bitboard per color, where
+        square (r, c) is bit r*7+c. _occupied is kept as the union of the three color bitboards.
         '''
 
-        self._players = {player1[0]: Player(
-            player1), player2[0]: Player(player2)}
+        # Players are addressed internally by their index, 0 or 1, so the opponent of a player is
+        # always the index XOR 1. _turn_idx is None until the first move is made.
+        self._players = (Player(player1, self), Player(player2, self))
+        self._name_to_idx = {player1[0]: 0, player2[0]: 1}
+        self._turn_idx = None
+
+        # Red marbles captured by each player, indexed like _players.
+        self._captured = [0, 0]
         self._game_winner = None
-        self._current_turn = None
 
-        # Initialize board with all X.
-        self._game_board = [["X"] * 7 for i in range(7)]
+        self._white, self._black, self._red = KubaGame._INITIAL_STATE
+        self._occupied = self._white | self._black | self._red
+
+        # Number of White, Black, and Red marbles on the board, updated as marbles are pushed off.
+        self._counts = list(KubaGame._INITIAL_COUNTS)
+
+        # Packed key of the board before the opposing player's move, used for the Ko rule.
+        self._prev_position_key = KubaGame._INITIAL_KEY
 
-        # Add white squares.
-        for i in range(2):
-            for j in range(2):
-                self._game_board[i][j] = "W"
-                self._game_board[6-i][6-j] = "W"
+        # Zobrist hashes of the current board and of the board before the opposing player's move.
+        self._hash = KubaGame._INITIAL_HASH
+        self._prev_hash = self._hash
 
-        # Add black squares.
-        for i in range(2):
-            for j in range(2):
-                self._game_board[i+5][j] = "B"
-                self._game_board[i][j+5] = "B"
+        # LRU caches keyed by Zobrist hash for whether a player is blocked and whether a push is legal.
+        self._blocked_cache = OrderedDict()
+        self._legal_move_cache = OrderedDict()
 
-        # Add red squares.
-        red_coordinates = [(1, 3), (2, 2), (2, 3), (2, 4), (3, 1), (3, 2),
-                           (3, 3), (3, 4), (3, 5), (4, 2), (4, 3), (4, 4), (5, 3)]
-        for marble in red_coordinates:
-            self._game_board[marble[0]][marble[1]] = "R"
+        # Game state saved before each successful move, most recent last, for undo_move.
+        self._history = []
 
-        # Initialize deep copy board to maintain the state of the board before the opposing player's move.
-        self._game_board_previous = deepcopy(self._game_board)
+        # Result of legal_moves for the current position, or None until it is requested.
+        self._legal_moves_cache = None
 
     def display_board(self):
         '''
@@ -72,37 +337,35 @@ class KubaGame:
         Also includes basic information of the game state.
         '''
 
-        print()
-        print("Captured Red Marbles")
+        parts = ["", "Captured Red Marbles"]
 
-        for player in self._players:
-            print(player + ": " +
-                  str(self._players[player].get_captured_red_marbles()))
+        for player, captured in zip(self._players, self._captured):
+            parts.append(player.get_name() + ": " + str(captured))
 
-        print()
-        print("Number of Marbles on Board")
+        parts.append("")
+        parts.append("Number of Marbles on Board")
 
-        color_tuple = ("White: ", "Black: ", "Red:   ")
-        counter = 0
-        for color in self.get_marble_count():
-            print(color_tuple[counter] + str(color))
-            counter += 1
-        print()
-        try:
-            print("Current Turn: " + self._current_turn)
-        except TypeError:
-            print("Anyone's turn.")
-        print()
-        print("-----------------")
-        for row in self._game_board:
+        white, black, red = self.get_marble_count()
+        parts.append("White: " + str(white))
+        parts.append("Black: " + str(black))
+        parts.append("Red:   " + str(red))
+        parts.append("")
 
-            print("|", end=" ")
+        if self._turn_idx is None:
+            parts.append("Anyone's turn.")
+        else:
+            parts.append("Current Turn: " + self.get_current_turn())
+
+        parts.append("")
+        parts.append("-----------------")
+        cells = self._render_board().decode()
+        for row in range(7):
+            parts.append("| " + " ".join(cells[row * 7:row * 7 + 7]) + " |")
+        parts.append("-----------------")
+        parts.append("")
 
-            for marble in row:
-                print(marble, end=" ")
-            print("|")
-        print("-----------------")
-        print()
+        # Write the whole board at once rather than one print() per marble.
+        sys.stdout.write("\n".join(parts) + "\n")
 
     def get_current_turn(self):
         '''
@@ -110,7 +373,10 @@ class KubaGame:
         None is returned.
         '''
 
-        return self._current_turn
+        if self._turn_idx is None:
+            return None
+
+        return self._players[self._turn_idx].get_name()
 
     def make_move(self, playername, coordinates, direction):
         '''
@@ -119,40 +385,168 @@ class KubaGame:
         right, 'F' is forward, and 'B' is back.)
 
         If the move is valid, the game board is updated to reflect the move. If a red marbles is
-        captured, the player's captured_red_marbles is incremented by 1. If the move wins the game, the
+        captured, the player's captured count is incremented by 1. If the move wins the game, the
         the internal self._game_winner variable is updated accordingly.
 
         If for any reason the move is not valid, False is returned, otherwise True.
         '''
 
-        if self._validate_move(playername, coordinates, direction):
+        player_idx = self._name_to_idx.get(playername)
+        direction = _DIR_INDEX.get(direction)
+        if player_idx is None or direction is None:
+            return False
+
+        square = _square_index(coordinates)
+        if square is None:
+            return False
+
+        if self._validate_move(player_idx, square, direction):
+
+            # Record everything the move changes so that undo_move can restore it.
+            self._history.append((self._white, self._black, self._red, self._turn_idx,
+                                  tuple(self._captured), self._game_winner, tuple(self._counts),
+                                  self._prev_position_key, self._hash, self._prev_hash))
 
-            # Save the game board for later reference while checking the Ko rule.
-            self._game_board_previous = deepcopy(self._game_board)
+            old_state = _position_key(self._white, self._black, self._red)
+            old_hash = self._hash
 
-            self._move_marble(playername, coordinates, direction, None)
+            self._move_marble(player_idx, square, direction)
 
-            self._current_turn = self._get_other_playername(playername)
+            # Save the previous game board for later reference while checking the Ko rule.
+            self._prev_position_key = old_state
+            self._prev_hash = old_hash
 
-            if self._check_for_winner(playername):
+            self._turn_idx = player_idx ^ 1
+            self._legal_moves_cache = None
+
+            if self._check_for_winner(player_idx):
                 self._game_winner = playername
 
             return True
         else:
             return False
 
-    def _get_other_playername(self, playername):
+    def undo_move(self):
         '''
-        Takes a player name as a parameter and returns the name of the other player.
+        Takes back the most recent successful move, restoring the board, turn, captured marbles,
+        winner, and Ko position to what they were before it was made.
+
+        Returns True if a move was undone and False if there are no moves to undo.
         '''
 
-        for key in self._players:
-            if key != playername:
-                return key
+        if not self._history:
+            return False
+
+        (self._white, self._black, self._red, self._turn_idx, captured,
+         self._game_winner, counts, self._prev_position_key, self._hash,
+         self._prev_hash) = self._history.pop()
 
-    def _check_for_winner(self, playername):
+        self._occupied = self._white | self._black | self._red
+        self._captured = list(captured)
+        self._counts = list(counts)
+        self._legal_moves_cache = None
+
+        return True
+
+    def clone(self):
         '''
-        Takes a player name and returns True if the specified player meets a win condition and False
+        Returns an independent copy of the game that can be played on without affecting this one.
+
+        The name lookup never changes after __init__ and is shared, as are the legality caches since
+        their entries depend only on the positions in their keys. The players are copied so that they
+        report the clone's captured marbles. Everything a move changes is copied.
+
+        The clone starts with an empty undo history, so its cost does not grow with the length of the
+        game. undo_move on the clone can only take back moves made on the clone itself.
+        '''
+
+        game = KubaGame.__new__(KubaGame)
+
+        game._players = (self._players[0]._bind(game), self._players[1]._bind(game))
+        game._name_to_idx = self._name_to_idx
+        game._turn_idx = self._turn_idx
+        game._captured = list(self._captured)
+        game._game_winner = self._game_winner
+
+        game._white, game._black, game._red = self._white, self._black, self._red
+        game._occupied = self._occupied
+        game._counts = list(self._counts)
+        game._prev_position_key = self._prev_position_key
+        game._hash = self._hash
+        game._prev_hash = self._prev_hash
+
+        game._blocked_cache = self._blocked_cache
+        game._legal_move_cache = self._legal_move_cache
+        game._history = []
+        game._legal_moves_cache = self._legal_moves_cache
+
+        return game
+
+    def __deepcopy__(self, memo):
+        '''
+        Makes copy.deepcopy use clone() instead of copying every attribute generically.
+        '''
+
+        return self.clone()
+
+    def legal_moves(self):
+        '''
+        Returns a frozenset of every valid move in the current position as (playername, coordinates,
+        direction) tuples, so each move can be passed straight to make_move. Only the moves of the
+        player whose turn it is are included, or of both players before the first move. Once the game
+        is won the set is empty.
+
+        The result is cached until the position changes.
+        '''
+
+        if self._legal_moves_cache is None:
+            self._legal_moves_cache = frozenset(self._enumerate_legal())
+
+        return self._legal_moves_cache
+
+    def _enumerate_legal(self):
+        '''
+        Yields every valid move in the current position as a (playername, coordinates, direction)
+        tuple. See legal_moves.
+        '''
+
+        player_indices = (0, 1) if self._turn_idx is None else (self._turn_idx,)
+
+        for player_idx in player_indices:
+            player = self._players[player_idx]
+            marbles = self._get_color_bb(player._color)
+
+            while marbles:
+                lowest_bit = marbles & -marbles
+                marbles ^= lowest_bit
+                square = lowest_bit.bit_length() - 1
+
+                for direction in self._direction_priority(square):
+                    if self._validate_move(player_idx, square, direction):
+                        yield (player._name, (square // 7, square % 7), "FBLR"[direction])
+
+    def state_key(self):
+        '''
+        Returns a hashable tuple of the (white, black, red) bitboards and the index of the player whose
+        turn it is (None before the first move), for use as a key when storing positions.
+        '''
+
+        return (self._white, self._black, self._red, self._turn_idx)
+
+    def zobrist_key(self):
+        '''
+        Returns the Zobrist hash of the position and the side to move as an int, for use as a compact
+        transposition table key. The key is updated incrementally as moves are made and undone.
+        '''
+
+        if self._turn_idx is None:
+            return self._hash
+
+        return self._hash ^ _ZOBRIST_TURN[self._turn_idx]
+
+    def _check_for_winner(self, player_idx):
+        '''
+        Takes a player index and returns True if the specified player meets a win condition and False
         otherwise.
 
         Win conditions are:
@@ -162,11 +556,11 @@ class KubaGame:
         '''
 
         # Check if this player just won with 7 marbles.
-        if self._players[playername].get_captured_red_marbles() > 6:
+        if self._captured[player_idx] > 6:
             return True
 
         # Check if the other player has 0 marbles.
-        if self._players[playername].get_color() == "B":
+        if self._players[player_idx]._color == BLACK:
             if self.get_marble_count()[0] < 1:
                 return True
         else:
@@ -174,36 +568,66 @@ class KubaGame:
                 return True
 
         # If the next player has no valid moves, the recent player is declared the winner. (optional)
-        if self._check_all_moves_blocked(playername):
+        if self._check_all_moves_blocked(player_idx):
             return True
 
         return False
 
-    def _check_all_moves_blocked(self, playername):
+    def _check_all_moves_blocked(self, player_idx):
         '''
-        Takes a player name and checks if the opposing player has any valid moves left. If all moves are
+        Takes a player index and checks if the opposing player has any valid moves left. If all moves are
         blocked, True is returned. False is returned otherwise.
         '''
 
-        possible_directions = ('F', 'B', 'L', 'R')
+        player_idx ^= 1
+        marble_color = self._players[player_idx]._color
 
-        playername = self._get_other_playername(playername)
-        marble_color = self._players[playername].get_color()
+        key = (self._hash, self._prev_hash, marble_color)
+        if key in self._blocked_cache:
+            self._blocked_cache.move_to_end(key)
+            return self._blocked_cache[key]
 
-        for i, row in enumerate(self._game_board):
-            for j, marble in enumerate(row):
-                if self._game_board[i][j] == marble_color:
-                    for direction in possible_directions:
-                        if self._validate_move(playername, (i, j), direction):
-                            return False
+        blocked = True
+        marbles = self._get_color_bb(marble_color)
 
-        return True
+        # Visit only the player's own marbles by popping the lowest set bit each time.
+        while marbles and blocked:
+            lowest_bit = marbles & -marbles
+            marbles ^= lowest_bit
+            square = lowest_bit.bit_length() - 1
+
+            for direction in self._direction_priority(square):
+                if self._validate_move(player_idx, square, direction):
+                    blocked = False
+                    break
 
-    def _validate_move(self, playername, coordinates, direction):
+        _cache_store(self._blocked_cache, key, blocked)
+        return blocked
+
+    def _direction_priority(self, square):
         '''
-        Takes the specified player name as a string, the coordinates as a tuple of the marble
-        that is being pushed, and the direction to push as a string ('L' is left, 'R' is
-        right, 'F' is forward, and 'B' is back.)
+        Takes a square index (r*7+c) and returns the direction indices the marble there could be pushed, most
+        promising first. Marbles on the edge being pushed inward come first, followed by marbles with
+        an empty square behind them. Directions with a marble behind can never be valid and are left
+        out.
+        '''
+
+        edge_directions = []
+        open_directions = []
+
+        for direction in range(4):
+            if not _BEHIND[direction][square]:
+                edge_directions.append(direction)
+            elif _check_open(self._occupied, square, direction):
+                open_directions.append(direction)
+
+        return edge_directions + open_directions
+
+    def _validate_move(self, player_idx, square, direction):
+        '''
+        Takes the specified player index (0 or 1), the square index (r*7+c) of the marble
+        that is being pushed, and the direction index (0 is 'F', 1 is 'B', 2 is 'L',
+        and 3 is 'R'.)
 
         If the move is valid, True is returned.
 
@@ -218,7 +642,7 @@ class KubaGame:
         '''
 
         # Check if it's the player's turn.
-        if not (playername == self._current_turn or self._current_turn is None):
+        if not (player_idx == self._turn_idx or self._turn_idx is None):
             return False
 
         # Check if there's a winner.
@@ -226,261 +650,176 @@ class KubaGame:
             return False
 
         # Check that the color of the selected marble is the player's chosen color.
-        if self._players[playername].get_color() != self.get_marble(coordinates):
+        player_marbles = self._get_color_bb(self._players[player_idx]._color)
+        if not player_marbles & (1 << square):
             return False
 
-        # Check that the marble to be moved is 'open'.
-        if not self._check_open_marble(coordinates, direction):
-            return False
-
-        # Check if the move will knock off the player's own marble.
-        if not self._check_selfdefeating_rule(playername, coordinates, direction):
-            return False
+        # The remaining checks depend only on the board and the Ko position, so reuse earlier results.
+        key = (self._hash, self._prev_hash, square, direction)
+        if key in self._legal_move_cache:
+            self._legal_move_cache.move_to_end(key)
+            return self._legal_move_cache[key]
 
-        # Check that the Ko rule isn't violated.
-        if not self._check_ko_rule(coordinates, direction):
-            return False
+        legal = self._check_push_rules(player_marbles, square, direction)
 
-        return True
+        _cache_store(self._legal_move_cache, key, legal)
+        return legal
 
-    def _check_open_marble(self, coordinates, direction):
+    def _check_push_rules(self, player_marbles, square, direction):
         '''
-        Takes the coordinates as a tuple of the marble that is being pushed, and the direction to push as a string ('L' is left, 'R' is
-        right, 'F' is forward, and 'B' is back.)
+        Takes the bitboard of the pushing player's marbles, the square index (r*7+c) of the marble
+        that is being pushed, and the direction index (0 is 'F', 1 is 'B', 2 is 'L', and 3 is 'R'.)
 
-        If the marble is 'open' and can be pushed, True is returned, otherwise False is returned.
+        Returns True if the marble is 'open', the push does not remove one of the player's own
+        marbles, and the Ko rule is not violated. False is returned otherwise.
         '''
 
-        if direction == "F":
-            blocking_spot = (coordinates[0] + 1, coordinates[1])
-        elif direction == "B":
-            blocking_spot = (coordinates[0] - 1, coordinates[1])
-        elif direction == "L":
-            blocking_spot = (coordinates[0], coordinates[1] + 1)
-        elif direction == "R":
-            blocking_spot = (coordinates[0], coordinates[1] - 1)
-
-        for index in blocking_spot:
-            if index < 0 or index > 6:
-                return True
+        # Check that the marble to be moved is 'open' and that the move won't knock off the player's
+        # own marble.
+        open_ok, self_ok = _analyze_push(self._occupied, player_marbles, square, direction)
+        if not (open_ok and self_ok):
+            return False
 
-        if self.get_marble(blocking_spot) == "X":
-            return True
-        else:
+        # Check that the Ko rule isn't violated.
+        if not self._check_ko_rule(square, direction):
             return False
 
-    def _check_ko_rule(self, coordinates, direction):
+        return True
+
+    def _check_ko_rule(self, square, direction):
         '''
-        Takes the coordinates as a tuple of the marble that is being pushed, and the direction to push as a string ('L' is left, 'R' is
-        right, 'F' is forward, and 'B' is back.)
+        Takes the square index (r*7+c) of the marble that is being pushed, and the direction index
+        (0 is 'F', 1 is 'B', 2 is 'L', and 3 is 'R'.)
+
+        The Ko rule is violated if the move would return the board to exactly the position it was in
+        before the opposing player's move, which is stored as a packed key in _prev_position_key.
 
         If the Ko rule is not violated, True is returned, otherwise False is returned.
         '''
 
-        temporary_board = deepcopy(self._game_board)
-
-        temporary_board = self._move_marble(
-            None, coordinates, direction, temporary_board)
+        # A push never adds marbles, so if the opposing player's move pushed one off the board the
+        # previous position can't come back and there is no need to simulate the move.
+        if self._prev_position_key.bit_count() != self._occupied.bit_count():
+            return True
 
-        for row_index, row in enumerate(temporary_board):
-            for col_index, marble in enumerate(row):
-                if marble != self._game_board_previous[row_index][col_index]:
-                    return True
+        white, black, red, _ = _simulate_push(self._white, self._black, self._red, square, direction)
 
-        return False
+        return _position_key(white, black, red) != self._prev_position_key
 
-    def _move_marble(self, playername, coordinates, direction, board):
+    def _move_marble(self, player_idx, square, direction):
         '''
-        Takes the specified player name as a string, the coordinates as a tuple of the marble
-        that is being pushed, the direction to push as a string ('L' is left, 'R' is
-        right, 'F' is forward, and 'B' is back.), and the board to make the move on.
-
-        If board is passed as None, then the private _game_board is updated. If playername
-        is not None, then any captured red marbles will appropriately increment for that player.
+        Takes the specified player index (0 or 1), the square index (r*7+c) of the marble
+        that is being pushed and the direction index (0 is 'F', 1 is 'B', 2 is 'L',
+        and 3 is 'R'.)
 
-        Returns the board with the updated marble positions.
+        The game board bitboards and marble counts are updated and a captured red marble is credited
+        to the player.
         '''
 
-        if board is None:
-            board = self._game_board
-
-        row = coordinates[0]
-        column = coordinates[1]
-        current_marble = board[row][column]
-        board[row][column] = "X"
+        white, black, red, fell_off = _simulate_push(self._white, self._black, self._red, square, direction)
 
-        if direction == "F":
-            while current_marble != "X":
-                row -= 1
+        # fell_off is at most one bit, so each bit count below is 0 or 1.
+        captured_red = (fell_off & self._red).bit_count()
+        self._counts[0] -= (fell_off & self._white).bit_count()
+        self._counts[1] -= (fell_off & self._black).bit_count()
+        self._counts[2] -= captured_red
+        self._captured[player_idx] += captured_red
 
-                previous_marble = current_marble
-                current_marble = board[row][column]
-                board[row][column] = previous_marble
+        self._hash ^= (_zobrist_diff(self._white, white, WHITE) ^ _zobrist_diff(self._black, black, BLACK)
+                       ^ _zobrist_diff(self._red, red, RED))
 
-                if row == 0 and current_marble != "X":
-                    if current_marble == "R" and playername is not None:
-                        self._players[playername].increment_captured_red_marbles()
-                    current_marble = "X"
+        self._white, self._black, self._red = white, black, red
+        self._occupied = white | black | red
 
-        elif direction == "B":
-            while current_marble != "X":
-                row += 1
-
-                previous_marble = current_marble
-                current_marble = board[row][column]
-                board[row][column] = previous_marble
-
-                if row == 6 and current_marble != "X":
-                    if current_marble == "R" and playername is not None:
-                        self._players[playername].increment_captured_red_marbles()
-                    current_marble = "X"
-
-        elif direction == "L":
-            while current_marble != "X":
-                column -= 1
-
-                previous_marble = current_marble
-                current_marble = board[row][column]
-                board[row][column] = previous_marble
-
-                if column == 0 and current_marble != "X":
-                    if current_marble == "R" and playername is not None:
-                        self._players[playername].increment_captured_red_marbles()
-                    current_marble = "X"
-
-        elif direction == "R":
-            while current_marble != "X":
-                column += 1
-
-                previous_marble = current_marble
-                current_marble = board[row][column]
-                board[row][column] = previous_marble
-
-                if column == 6 and current_marble != "X":
-                    if current_marble == "R" and playername is not None:
-                        self._players[playername].increment_captured_red_marbles()
-                    current_marble = "X"
-
-        return board
-
-    def _check_selfdefeating_rule(self, playername, coordinates, direction):
+    def get_winner(self):
         '''
-        Takes the specified player name as a string, the coordinates as a tuple of the marble
-        that is being pushed, and the direction to push as a string ('L' is left, 'R' is
-        right, 'F' is forward, and 'B' is back.)
-
-        Determines whether the move removes one of the player's own marbles from the board.
-
-        Returns True if the rule is not violated and False otherwise.
+        Returns the name of the winning player. If there is no winner yet, None is returned.
         '''
 
-        player_marble_color = self._players[playername].get_color()
-
-        row = coordinates[0]
-        column = coordinates[1]
-        current_marble = self._game_board[row][column]
-
-        if direction == "F":
-            if row == 0 and current_marble == player_marble_color:
-                return False
-
-            while current_marble != "X":
-                row -= 1
-                current_marble = self._game_board[row][column]
-
-                if row == 0:
-                    if current_marble == player_marble_color:
-                        return False
-                    else:
-                        current_marble = "X"
+        return self._game_winner
 
-        elif direction == "B":
-            if row == 6 and current_marble == player_marble_color:
-                return False
+    def get_captured(self, playername):
+        '''
+        Takes a player name and returns the number of Red marbles captured by the specified
+        player.
+        '''
 
-            while current_marble != "X":
-                row += 1
-                current_marble = self._game_board[row][column]
+        return self._captured[self._name_to_idx[playername]]
 
-                if row == 6:
-                    if current_marble == player_marble_color:
-                        return False
-                    else:
-                        current_marble = "X"
+    def get_marble(self, coordinates):
+        '''
+        Takes coordinates as a tuple and returns the marble that is present at the specified location
+        as R (red), B (black), and W (white). If there is no marble at the specified location, 'X" is
+        returned. An IndexError is raised if the coordinates are off the board.
+        '''
 
-        elif direction == "L":
-            if column == 0 and current_marble == player_marble_color:
-                return False
+        square = _square_index(coordinates)
+        if square is None:
+            raise IndexError("Coordinates " + str(coordinates) + " are off the board")
 
-            while current_marble != "X":
-                column -= 1
-                current_marble = self._game_board[row][column]
+        return _CODE_TO_STR[self._get_square_marble(square)]
 
-                if column == 0:
-                    if current_marble == player_marble_color:
-                        return False
-                    else:
-                        current_marble = "X"
+    def get_marbles(self, coordinates_list):
+        '''
+        Takes an iterable of coordinate tuples and returns a list of the marbles at those locations, in
+        the same order, using the same letters as get_marble. An IndexError is raised if any of the
+        coordinates are off the board.
+        '''
 
-        elif direction == "R":
-            if column == 6 and current_marble == player_marble_color:
-                return False
+        return [self.get_marble(coordinates) for coordinates in coordinates_list]
 
-            while current_marble != "X":
-                column += 1
-                current_marble = self._game_board[row][column]
+    def _get_square_marble(self, square):
+        '''
+        Takes a square index (r*7+c) and returns the code of the marble at that square: WHITE, BLACK,
+        RED, or EMPTY.
+        '''
 
-                if column == 6:
-                    if current_marble == player_marble_color:
-                        return False
-                    else:
-                        current_marble = "X"
+        bit = 1 << square
 
-        return True
+        if self._white & bit:
+            return WHITE
+        if self._black & bit:
+            return BLACK
+        if self._red & bit:
+            return RED
+        return EMPTY
 
-    def get_winner(self):
+    def _render_board(self):
         '''
-        Returns the name of the winning player. If there is no winner yet, None is returned.
+        Returns the board as a flat bytearray of 49 letters, one per square in r*7+c order, using
+        R (red), B (black), W (white), and X for empty squares.
         '''
 
-        return self._game_winner
+        cells = bytearray(b"X" * 49)
 
-    def get_captured(self, playername):
-        '''
-        Takes a player name and returns the number of Red marbles captured by the specified
-        player.
-        '''
+        for marbles, letter in ((self._white, ord("W")), (self._black, ord("B")), (self._red, ord("R"))):
+            while marbles:
+                lowest_bit = marbles & -marbles
+                marbles ^= lowest_bit
+                cells[lowest_bit.bit_length() - 1] = letter
 
-        return self._players[playername].get_captured_red_marbles()
+        return cells
 
-    def get_marble(self, coordinates):
+    def _get_color_bb(self, color):
         '''
-        Takes coordinates as a tuple and returns the marble that is present at the specified location
-        as R (red), B (black), and W (white). If there is no marble at the specified location, 'X" is
-        returned.
+        Takes a marble code (WHITE, BLACK, or RED) and returns the bitboard for that color. An empty
+        bitboard is returned for any other code.
         '''
 
-        return self._game_board[coordinates[0]][coordinates[1]]
+        if color == WHITE:
+            return self._white
+        if color == BLACK:
+            return self._black
+        if color == RED:
+            return self._red
+        return 0
 
     def get_marble_count(self):
         '''
         Returns the number of White, Black, and Red marbles on the board as a tuple in the order (W,B,R).
         '''
 
-        white = 0
-        black = 0
-        red = 0
-
-        for row in self._game_board:
-            for marble in row:
-                if marble == "R":
-                    red += 1
-                elif marble == "B":
-                    black += 1
-                elif marble == "W":
-                    white += 1
-
-        return (white, black, red)
+        return tuple(self._counts)
 
 
 class Player:
@@ -488,52 +827,68 @@ class Player:
     Represents a player in the game "Kuba".
 
     Responsible for:
-        - Storing and returning the player's name, color, and the number of captured Red marbles.
-        - Incrementing the number of captured Red marbles when a Red marble is captured by the player.
+        - Storing and returning the player's name and color.
+        - Returning the number of Red marbles the player has captured, as recorded by their game.
 
     While the class itself can operate with no dependencies, its functionality is centered around the
-    KubaGame class.
+    KubaGame class. Captured marbles are counted by KubaGame, so the player has no way to increment
+    them itself.
     '''
 
-    def __init__(self, player_tuple):
+    __slots__ = ("_name", "_color", "_game")
+
+    def __init__(self, player_tuple, game=None):
         '''
         Initializes a player by taking a tuple of length two with the first value the player name and the
-        second the color represented as either "W" or "B".
+        second the color represented as either "W" or "B", and optionally the KubaGame the player is
+        part of. The color is stored as its WHITE or BLACK code.
 
-        The number of captured red marbles is initially set to 0.
+        A ValueError is raised for any other color.
         '''
 
+        if player_tuple[1] not in _PLAYER_COLORS:
+            raise ValueError("Player color must be 'W' or 'B', not " + repr(player_tuple[1]))
+
         self._name = player_tuple[0]
-        self._color = player_tuple[1]
-        self._captured_red_marbles = 0
+        self._color = _PLAYER_COLORS[player_tuple[1]]
+        self._game = game
 
-    def get_name(self):
+    def _bind(self, game):
         '''
-        Returns the name of the player.
+        Takes a KubaGame and returns a copy of the player that belongs to that game.
         '''
 
-        return self._name
+        player = Player.__new__(Player)
+        player._name = self._name
+        player._color = self._color
+        player._game = game
 
-    def get_color(self):
+        return player
+
+    def get_name(self):
         '''
-        Returns the color of the player's chosen marble.
+        Returns the name of the player.
         '''
 
-        return self._color
+        return self._name
 
-    def increment_captured_red_marbles(self):
+    def get_color(self):
         '''
-        Increments the number of Red marbles captured by the player by 1.
+        Returns the color of the player's chosen marble as either "W" or "B".
         '''
 
-        self._captured_red_marbles += 1
+        return _CODE_TO_STR[self._color]
 
     def get_captured_red_marbles(self):
         '''
-        Returns the number of Red marbles captured by the player.
+        Returns the number of Red marbles captured by the player, read from the game the player is part
+        of. A player that is not part of a game has captured 0.
         '''
 
-        return self._captured_red_marbles
+        if self._game is None:
+            return 0
+
+        return self._game.get_captured(self._name)
 
 
 def main():